@@ -1,45 +1,202 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import io
+import hashlib
+
+try:
+    import polars as pl
+except ImportError:  # optional, multi-threaded lookup backend
+    pl = None
 
 # --- Helper Functions ---
 
+NOT_FOUND = '--- NOT FOUND ---'
+
 def to_excel(df):
     """Converts a pandas DataFrame to an in-memory Excel file (bytes)."""
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+    # Don't use xlsxwriter's constant_memory option here: DataFrame.to_excel writes cells column
+    # by column, and constant_memory silently drops any write to a row it has already flushed.
+    # The workbook is still built in memory; use_zip64 only lifts the 4GB zip size limit
+    # so very large outputs can be written at all.
+    writer_options = {'use_zip64': True}
+    with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': writer_options}) as writer:
         df.to_excel(writer, index=False, sheet_name='ConvertedParts')
     processed_data = output.getvalue()
     return processed_data
 
-def load_data_file(uploaded_file, header_row=1):
+def to_csv(df):
+    """Converts a pandas DataFrame to in-memory CSV (bytes)."""
+    output = io.BytesIO()
+    df.to_csv(output, index=False)
+    return output.getvalue()
+
+def to_parquet(df):
+    """Converts a pandas DataFrame to an in-memory Parquet file (bytes)."""
+    output = io.BytesIO()
+    # Excel columns often mix numbers and text, which Arrow can't store in one column.
+    object_cols = df.select_dtypes(include='object').columns
+    df = df.astype({col: 'string' for col in object_cols})
+    df.columns = df.columns.astype(str)
+    df.to_parquet(output, engine='pyarrow', compression='zstd', index=False)
+    return output.getvalue()
+
+def clean_keys(series):
     """
-    Intelligently loads data files, allowing the user to specify the header row.
-    Handles various Excel formats and delimited text files.
+    Normalises a part number column for matching: casts to Arrow-backed strings and
+    trims surrounding whitespace with Arrow's vectorised trim kernel.
+    """
+    return series.astype('string[pyarrow]').str.strip()
+
+def _arrow_keys(series):
+    """Returns a cleaned key Series as a single contiguous pyarrow string Array."""
+    arr = pa.array(series, type=pa.string())
+    return arr.combine_chunks() if isinstance(arr, pa.ChunkedArray) else arr
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def build_master_lookup(file_bytes, name, header_row, key_col, value_col):
     """
-    skiprows = header_row - 1
-    file_name_lower = uploaded_file.name.lower()
+    Loads just the key and value columns of the master file and de-duplicates the
+    cleaned keys (first occurrence of each key wins).
+    Cached as a resource so converting several data files against the same master
+    reuses the prepared keys instead of cleaning and de-duplicating them again. The cache
+    is shared by all sessions, so only the last few masters are kept.
+    Returns (keys, values) where keys is a pyarrow Array and values[i] belongs to
+    keys[i], or None. values ends with an extra NOT_FOUND entry so that an unmatched
+    code of -1 picks it up.
+    """
+    # Read uncached: this entry is the only copy of the master that should stay resident.
+    master_df = _read_data_file(file_bytes, name, header_row, tuple(dict.fromkeys([key_col, value_col])))
+    if master_df is None:
+        return None
+
+    # One hashing pass over the Arrow keys marks the first occurrence of each key.
+    keys = clean_keys(master_df[key_col])
+    first = (keys.notna() & ~keys.duplicated(keep='first')).to_numpy()
+    unique_keys = _arrow_keys(keys[first])
+    # A matched key with a blank new part number is reported as not found.
+    values = np.append(master_df[value_col].to_numpy()[first].astype(object), NOT_FOUND)
+    values[pd.isna(values)] = NOT_FOUND
+    return unique_keys, values
+
+def lookup_codes(master_keys, user_keys):
+    """
+    Returns, for each user key, its position in the unique master keys, or -1 if it
+    isn't there. Uses Arrow's hash-based index_in kernel directly on the string
+    buffers, so no Python string objects are created.
+    """
+    codes = pc.index_in(_arrow_keys(user_keys), value_set=master_keys)
+    return codes.fill_null(-1).to_numpy()
+
+def lookup_codes_polars(master_keys, user_keys):
+    """
+    Polars equivalent of `lookup_codes`. The join runs multi-threaded in Rust on the
+    Arrow buffers.
+    """
+    master = pl.DataFrame({'key': pl.from_arrow(master_keys)}).with_row_index('code')
+    user = pl.DataFrame({'key': pl.from_pandas(user_keys)}).with_row_index('row')
+    joined = user.join(master, on='key', how='left').sort('row')
+    return joined['code'].cast(pl.Int64).fill_null(-1).to_numpy()
+
+DOWNLOAD_FORMATS = {
+    "CSV": (to_csv, "csv", "text/csv"),
+    "Parquet": (to_parquet, "parquet", "application/vnd.apache.parquet"),
+    "XLSX": (to_excel, "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+def _parse_file(file_bytes, name, read_opts):
+    """Reads the raw bytes of an uploaded file with the reader that suits its extension."""
+    file_name_lower = name.lower()
+    buf = io.BytesIO(file_bytes)
 
+    if file_name_lower.endswith('.tsv'):
+        return pd.read_csv(buf, on_bad_lines='skip', **read_opts, sep='\t', engine='c')
+
+    elif file_name_lower.endswith(('.csv', '.txt')):
+        # Try comma with the fast parser, then sniff: .txt can use any delimiter, and many
+        # locales export .csv from Excel with semicolons.
+        try:
+            df = pd.read_csv(buf, on_bad_lines='skip', **read_opts, sep=',', engine='c')
+            if df.shape[1] > 1:
+                return df
+        except pd.errors.ParserError:
+            pass
+        buf.seek(0)
+        return pd.read_csv(buf, on_bad_lines='skip', **read_opts, sep=None, engine='python')
+
+    elif file_name_lower.endswith(('.xlsx', '.xlsm', '.xls', '.xlsb')):
+        try:
+            return pd.read_excel(buf, engine='calamine', **read_opts)
+        except Exception:
+            # Fall back to the format-specific engines if calamine can't handle the file.
+            buf.seek(0)
+
+        if file_name_lower.endswith('.xlsb'):
+            return pd.read_excel(buf, engine='pyxlsb', **read_opts)
+        try:
+            return pd.read_excel(buf, engine='openpyxl', **read_opts)
+        except Exception as e:
+            if "zip file" in str(e).lower() or file_name_lower.endswith('.xls'):
+                buf.seek(0)
+                return pd.read_excel(buf, engine='xlrd', **read_opts)
+            else:
+                raise e
+
+def _optimize_dtypes(df):
+    """
+    Shrinks a freshly loaded frame: integer columns are downcast to the smallest type
+    that holds them and all-text columns become Arrow-backed strings. Floats and mixed
+    number/text columns are left as they are so no values change.
+    """
+    for i in range(df.shape[1]):
+        col = df.iloc[:, i]
+        if pd.api.types.is_integer_dtype(col):
+            df.isetitem(i, pd.to_numeric(col, downcast='integer'))
+        elif col.dtype == object and pd.api.types.infer_dtype(col, skipna=True) == 'string':
+            df.isetitem(i, col.astype('string[pyarrow]'))
+    return df
+
+def _read_data_file(file_bytes, name, header_row, usecols=None, nrows=None):
+    """Uncached body of `load_data_file`, for cached loaders that need the frame themselves."""
+    # Match labels with a callable: Excel headers can be numbers, which pandas would
+    # otherwise read as column positions. The tuple itself stays the hashable cache key.
+    select_cols = (lambda col: col in usecols) if usecols is not None else None
+    read_opts = {'header': header_row - 1, 'usecols': select_cols, 'nrows': nrows}
     try:
-        if file_name_lower.endswith(('.csv', '.tsv', '.txt')):
-            return pd.read_csv(uploaded_file, on_bad_lines='skip', header=skiprows, sep=None, engine='python')
-
-        elif file_name_lower.endswith('.xlsb'):
-            return pd.read_excel(uploaded_file, engine='pyxlsb', header=skiprows)
-
-        elif file_name_lower.endswith(('.xlsx', '.xlsm', '.xls')):
-            try:
-                return pd.read_excel(uploaded_file, engine='openpyxl', header=skiprows)
-            except Exception as e:
-                if "zip file" in str(e).lower() or file_name_lower.endswith('.xls'):
-                    uploaded_file.seek(0)
-                    return pd.read_excel(uploaded_file, engine='xlrd', header=skiprows)
-                else:
-                    raise e
+        df = _parse_file(file_bytes, name, read_opts)
     except Exception as e:
-        st.error(f"Failed to read file '{uploaded_file.name}'. Error: {e}")
+        st.error(f"Failed to read file '{name}'. Error: {e}")
         st.info("Please ensure the 'Header is on which row?' value is correct. The selected row must contain the column names.")
         return None
+    return _optimize_dtypes(df) if df is not None else None
+
+@st.cache_data(show_spinner=False)
+def load_data_file(file_bytes: bytes, name: str, header_row: int = 1, usecols=None, nrows=None) -> pd.DataFrame:
+    """
+    Intelligently loads data files, allowing the user to specify the header row.
+    Handles various Excel formats and delimited text files.
+    Takes the upload's bytes (read once per run) and is cached on them, so Streamlit
+    reruns don't re-parse the same upload.
+    Pass `usecols` (a tuple of header labels) to load only those columns, or `nrows` to
+    load a preview.
+    """
+    return _read_data_file(file_bytes, name, header_row, usecols, nrows)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_data_with_keys(file_bytes: bytes, name: str, header_row: int, col):
+    """
+    Loads the full data file together with its cleaned key column as one cache entry,
+    so Convert parses and deserializes the frame only once. Cached so swapping the
+    master and converting again only repeats the master-side work.
+    Returns (df, keys), or None if the file can't be read.
+    """
+    df = _read_data_file(file_bytes, name, header_row)
+    if df is None:
+        return None
+    return df, clean_keys(df[col])
 
 # --- Streamlit App UI ---
 
@@ -70,7 +227,7 @@ with st.expander("ℹ️ Need Help? Click here for instructions and tips.", expa
 
         **4. Convert and Download:**
         -   Click the **"Convert Part Numbers"** button. The app will add a new column to your data file with the converted numbers.
-        -   You can then download the result as a new Excel file.
+        -   Choose a download format and click **"Prepare <format> Download"** (for example **"Prepare CSV Download"**), then download the result as a CSV, Parquet or Excel file. CSV is the fastest; choose XLSX if you need to open it as a workbook.
 
         ### Troubleshooting Tips
 
@@ -86,6 +243,7 @@ with st.expander("ℹ️ Need Help? Click here for instructions and tips.", expa
 st.header("1. Upload Your Files")
 
 SUPPORTED_TYPES = ["csv", "tsv", "txt", "xlsx", "xls", "xlsm", "xlsb"]
+PREVIEW_ROWS = 50
 col1, col2 = st.columns(2)
 
 with col1:
@@ -99,16 +257,19 @@ with col2:
 # --- 2. Load data and show UI ---
 if master_file and user_file:
     with st.spinner("Loading files..."):
-        master_df = load_data_file(master_file, master_header_row)
-        user_df = load_data_file(user_file, user_header_row)
+        # Read each upload once per run; every loader below parses and cache-keys these bytes.
+        master_bytes = master_file.getvalue()
+        user_bytes = user_file.getvalue()
+        master_df = load_data_file(master_bytes, master_file.name, master_header_row, nrows=PREVIEW_ROWS)
+        user_df = load_data_file(user_bytes, user_file.name, user_header_row, nrows=PREVIEW_ROWS)
 
     if master_df is not None and user_df is not None:
         st.success("Files loaded successfully! Please select the columns below.")
 
         with st.expander("Show Master File Preview", expanded=True):
-            st.dataframe(master_df.head())
+            st.dataframe(master_df.head(), use_container_width=True)
         with st.expander("Show Your Data File Preview", expanded=True):
-            st.dataframe(user_df.head())
+            st.dataframe(user_df.head(), use_container_width=True)
 
         st.header("2. Select Key Columns")
         master_cols = master_df.columns.tolist()
@@ -128,34 +289,57 @@ if master_file and user_file:
             user_e_col = st.selectbox("Select the column with E-Numbers to convert:", user_cols, index=user_e_col_index)
 
         st.header("3. Process and Download")
+        download_format = st.radio("Download format:", list(DOWNLOAD_FORMATS), horizontal=True)
+        use_polars = pl is not None and st.checkbox("Use Polars for the lookup (faster on very large files)", value=True)
+
+        # Tie a result to the file contents, not just names, so a corrected re-upload isn't
+        # mistaken for the file the result was made from.
+        conversion_inputs = (hashlib.sha256(master_bytes).hexdigest(), master_header_row, master_e_col, new_part_col,
+                             hashlib.sha256(user_bytes).hexdigest(), user_header_row, user_e_col)
 
         if st.button("🚀 Convert Part Numbers", type="primary"):
             with st.spinner("Processing..."):
-                user_df_copy = user_df.copy()
-                master_df_copy = master_df.copy()
+                # The previews only hold the first rows; load the full data file now.
+                master_lookup = build_master_lookup(master_bytes, master_file.name, master_header_row, master_e_col, new_part_col)
+                user_data = load_data_with_keys(user_bytes, user_file.name, user_header_row, user_e_col)
+                if master_lookup is None or user_data is None:
+                    st.stop()
 
-                mapping_df = master_df_copy[[master_e_col, new_part_col]].copy()
-                mapping_df[master_e_col] = mapping_df[master_e_col].astype(str).str.strip()
-                user_df_copy[user_e_col] = user_df_copy[user_e_col].astype(str).str.strip()
-                mapping_df.drop_duplicates(subset=[master_e_col], inplace=True)
+                master_keys, master_values = master_lookup
+                user_df, user_keys = user_data
+                # Unmatched keys get -1, which gathers the trailing NOT_FOUND entry, so the
+                # default is applied in the same pass.
+                if use_polars:
+                    codes = lookup_codes_polars(master_keys, user_keys)
+                else:
+                    codes = lookup_codes(master_keys, user_keys)
+                converted = master_values[codes]
 
-                result_df = pd.merge(user_df_copy, mapping_df, left_on=user_e_col, right_on=master_e_col, how='left')
-                
                 new_col_name = "Converted Part Number"
-                result_df.rename(columns={new_part_col: new_col_name}, inplace=True)
-                if user_e_col != master_e_col:
-                    result_df.drop(columns=[master_e_col], inplace=True)
-                result_df[new_col_name].fillna('--- NOT FOUND ---', inplace=True)
-
-                st.success("✅ Conversion Complete!")
-                st.dataframe(result_df)
-                
-                excel_data = to_excel(result_df)
+                result_df = user_df.assign(**{new_col_name: converted})
+                # Serialized downloads are kept alongside the result, keyed by format.
+                st.session_state['conversion'] = (conversion_inputs, result_df, {})
+
+        # The result is kept in session state so it survives the rerun from the download buttons.
+        # It is only shown while the files and columns it was made from are still selected.
+        conversion = st.session_state.get('conversion')
+        if conversion is not None and conversion[0] == conversion_inputs:
+            _, result_df, downloads = conversion
+            st.success("✅ Conversion Complete!")
+            st.dataframe(result_df)
+
+            # Serializing a large result is slow, so only do it once a download is asked for,
+            # and keep the bytes with this result so repeat downloads don't redo it.
+            serialize, extension, mime = DOWNLOAD_FORMATS[download_format]
+            if download_format not in downloads and st.button(f"Prepare {download_format} Download"):
+                with st.spinner(f"Preparing {download_format} file..."):
+                    downloads[download_format] = serialize(result_df)
+            if download_format in downloads:
                 st.download_button(
-                    label="📥 Download Converted Excel File",
-                    data=excel_data,
-                    file_name="converted_part_numbers.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                    label=f"📥 Download Converted {download_format} File",
+                    data=downloads[download_format],
+                    file_name=f"converted_part_numbers.{extension}",
+                    mime=mime
                 )
 
 st.markdown("---")
\ No newline at end of file